@@ -1,8 +1,14 @@
 """This Assemblyline service decompiles .NET dlls."""
 
+import json
+import mmap
 import os
+import re
 import shutil
+import struct
 import subprocess
+import tempfile
+import zipfile
 
 from assemblyline_v4_service.common.base import ServiceBase
 from assemblyline_v4_service.common.request import ServiceRequest
@@ -13,140 +19,391 @@ from assemblyline_v4_service.common.result import (
 )
 
 
+# Key and optional parenthesized value of an [assembly: ...] line
+ASSEMBLY_ATTRIBUTE_RE = re.compile(rb"^\[assembly: ([^(\]\n]+)(?:\((.*)\))?\]", re.M)
+
+
+def read_assembly_attribute_block(path):
+    """Return the (key, value) pairs of the first contiguous block of [assembly: ...] lines.
+
+    The file is memory-mapped and scanned by a single compiled regex, so the whole scan runs
+    in C over raw bytes with no per-line Python work; only the matched keys and values are
+    decoded, and the scan stops once the contiguous block ends.
+    """
+    items = []
+    if os.path.getsize(path) == 0:
+        return items
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+        last_end = -1
+        for match in ASSEMBLY_ATTRIBUTE_RE.finditer(mm):
+            # The entries are all in a single block (allowing for the line ending in between),
+            # stop scanning once we get over that block
+            if last_end != -1 and match.start() > last_end + 2:
+                break
+            k = match.group(1).decode("utf-8", "replace")
+            v = (match.group(2) or b"").decode("utf-8", "replace")
+            items.append((k, v))
+            last_end = match.end()
+    return items
+
+
+# Index of the CLR Runtime header in the PE optional header's data directories
+CLR_HEADER_INDEX = 14
+
+
+def has_clr_metadata(file_path):
+    """Cheaply check the PE headers for a CLR Runtime header (data directory 14).
+
+    A definitive "no CLR header" saves the full ilspycmd startup for every non-Dotnet
+    file the service is fed. Anything that cannot be parsed returns True so ilspycmd
+    stays the authority on ambiguous input.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            dos_header = f.read(0x40)
+            if len(dos_header) < 0x40 or dos_header[:2] != b"MZ":
+                return False
+            (e_lfanew,) = struct.unpack_from("<I", dos_header, 0x3C)
+            f.seek(e_lfanew)
+            pe_header = f.read(24)
+            if len(pe_header) < 24 or pe_header[:4] != b"PE\0\0":
+                return False
+            (size_of_optional_header,) = struct.unpack_from("<H", pe_header, 20)
+            optional_header = f.read(size_of_optional_header)
+            (magic,) = struct.unpack_from("<H", optional_header, 0)
+            if magic == 0x10B:  # PE32
+                directories_offset = 96
+            elif magic == 0x20B:  # PE32+
+                directories_offset = 112
+            else:
+                return True
+            (number_of_directories,) = struct.unpack_from("<I", optional_header, directories_offset - 4)
+            if number_of_directories <= CLR_HEADER_INDEX:
+                return False
+            rva, size = struct.unpack_from("<II", optional_header, directories_offset + CLR_HEADER_INDEX * 8)
+            return rva != 0 or size != 0
+    except (OSError, struct.error):
+        return True
+
+
+def archive_project(project_folder, zip_path):
+    """Zip the project tree without compressing it.
+
+    The archive is only a container for download and browsing, and deflating mostly-text C#
+    is CPU-bound on zlib for no benefit here, so the files are stored as-is.
+    """
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zip_file:
+        folders = [project_folder]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    else:
+                        zip_file.write(entry.path, os.path.relpath(entry.path, project_folder))
+
+
+# Known-benign ilspycmd failures, combined in one pattern so stderr is scanned a single time:
+# - BadImageFormatException: not a Dotnet File
+# - PEFileNotSupportedException: file not supported by ILSpy, probably not a Dotnet File
+# - NullReferenceException: a real Dotnet File, but corrupted
+# - no managed metadata: the PEReader couldn't find a Metadata File
+BENIGN_ILSPYCMD_ERRORS = re.compile(
+    rb"System\.BadImageFormatException"
+    rb"|PEFileNotSupportedException"
+    rb"|System\.NullReferenceException: Object reference not set to an instance of an object"
+    rb"|PE file does not contain any managed metadata"
+)
+
+
 def should_raise_ilspycmd_exception(stderr):
-    if b"System.BadImageFormatException" in stderr:
-        # Not a Dotnet File
-        return False
-    if b"PEFileNotSupportedException" in stderr:
-        # File not supported by ILSpy, probably not a Dotnet File
-        return False
-    if b"System.NullReferenceException: Object reference not set to an instance of an object" in stderr:
-        # A real Dotnet File, but corrupted
-        return False
-    if b"PE file does not contain any managed metadata" in stderr:
-        # The PEReader couldn't find a Metadata File.
-        return False
-    # Unexpected decompilation error
-    return True
+    # Anything else is an unexpected decompilation error
+    return BENIGN_ILSPYCMD_ERRORS.search(stderr) is None
 
 
 class DotnetDecompiler(ServiceBase):
     """This Assemblyline service decompiles .NET dlls."""
 
-    def execute(self, request: ServiceRequest):
-        request.result = Result()
+    def start(self):
+        # Hosting the decompiler engine in-process pays CLR startup once for the whole
+        # service lifetime instead of on every invocation
+        self._ilspy_host = None
+        if self.config.get("use_in_process_decompiler", False):
+            try:
+                from dotnet_decompiler.ilspy_host import IlspyHost
 
-        # In case decompilation is too mangled, the IL Code could give more hints as to what the executable is doing.
-        popenargs = [
-            "ilspycmd",
-            "--disable-updatecheck",
-            "--ilcode",
-            # "--il-sequence-points", # Show IL with sequence points.
-            "--outputdir",
-            self.working_directory,
-            request.file_path,
-        ]
-        p = subprocess.run(popenargs, capture_output=True)
-        if p.returncode == 0:
-            il_file_path = os.path.join(
-                self.working_directory, os.path.splitext(os.path.basename(request.file_path))[0] + ".il"
-            )
-            request.add_supplementary(
-                name=os.path.basename(il_file_path), description="IL Code file", path=il_file_path
-            )
-        elif should_raise_ilspycmd_exception(p.stderr):
-            # IL Code should always be available.
-            raise Exception(p.stderr)
-        else:
-            # A known error happened, no need to try full decompilation
-            return
+                self._ilspy_host = IlspyHost()
+            except Exception as e:
+                self.log.warning(f"Could not host ILSpy in-process, falling back to ilspycmd: {e}")
 
-        # Start by decompiling everything as one file for further analysis
-        popenargs = ["ilspycmd", "--disable-updatecheck", "--outputdir", self.working_directory, request.file_path]
-        p = subprocess.run(popenargs, capture_output=True)
+        if self._ilspy_host is None:
+            # ilspycmd has no long-lived/server mode, so every job pays some CLR startup cost.
+            # Run a throwaway invocation once here so the runtime and the tool's assemblies are
+            # loaded and page-cached before the first sample arrives, instead of on its clock.
+            subprocess.run(
+                ["ilspycmd", "--version"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
 
-        if p.returncode != 0:
-            if should_raise_ilspycmd_exception(p.stderr):
-                # Tell the user about the unexpected error, but assume that the ILCode will still help.
-                ResultSection(
-                    "ILSpyCmd Error", body=p.stderr.decode("UTF8", errors="backslashreplace"), parent=request.result
+        # Intermediate decompiler output is consumed in-process within seconds and then thrown
+        # away; a tmpfs avoids write-back to the worker's (possibly slow) disk. Containers cap
+        # /dev/shm at 64MB by default, which both concurrent passes can easily overflow, so a
+        # tmpfs is only used when the deployment explicitly mounts and sizes one.
+        self._scratch_root = None
+        tmpfs_scratch_directory = self.config.get("tmpfs_scratch_directory")
+        if tmpfs_scratch_directory:
+            if os.path.isdir(tmpfs_scratch_directory):
+                self._scratch_root = tempfile.mkdtemp(prefix="dotnet_decompiler_", dir=tmpfs_scratch_directory)
+            else:
+                self.log.warning(
+                    f"tmpfs_scratch_directory {tmpfs_scratch_directory} does not exist, "
+                    "staging intermediate output in the working directory instead"
                 )
-            return
 
-        # ILSpy always extracts following the input filename
-        decompiled_file_path = os.path.join(
-            self.working_directory, os.path.splitext(os.path.basename(request.file_path))[0] + ".decompiled.cs"
+    def stop(self):
+        if self._scratch_root:
+            shutil.rmtree(self._scratch_root, ignore_errors=True)
+
+    def _cache_entry(self, sha256):
+        """Return the cache folder for a given file hash, or None when caching is disabled."""
+        cache_directory = self.config.get("cache_directory")
+        if not cache_directory:
+            return None
+        return os.path.join(cache_directory, sha256[:2], sha256)
+
+    def _replay_cached_result(self, request: ServiceRequest, cache_entry):
+        """Rebuild the result and artifacts from a previous run on the same file, if any."""
+        manifest_path = os.path.join(cache_entry, "manifest.json")
+        base = os.path.splitext(os.path.basename(request.file_path))[0]
+        il_file_path = os.path.join(self.working_directory, base + ".il")
+        decompiled_file_path = os.path.join(self.working_directory, base + ".decompiled.cs")
+        zip_path = os.path.join(self.working_directory, "project.zip")
+        project_folder = os.path.join(self.working_directory, "project")
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                information_items = json.load(manifest_file)["assembly_info"]
+            shutil.copy(os.path.join(cache_entry, "il"), il_file_path)
+            shutil.copy(os.path.join(cache_entry, "decompiled.cs"), decompiled_file_path)
+            shutil.copy(os.path.join(cache_entry, "project.zip"), zip_path)
+        except (OSError, ValueError, KeyError, TypeError):
+            # Missing or corrupted entry, fall through to a normal run
+            return False
+
+        request.add_supplementary(name=base + ".il", description="IL Code file", path=il_file_path)
+        self._add_assembly_info_section(request, information_items)
+        request.add_extracted(
+            name=base + ".decompiled.cs", description="Decompiled file", path=decompiled_file_path
         )
-        if not os.path.exists(decompiled_file_path):
-            raise Exception("No ILSpy decompilation found.")
+        request.add_supplementary(name="project.zip", description="Project folder", path=zip_path)
+        if self.config.get("emit_individual_project_files", False):
+            shutil.unpack_archive(zip_path, project_folder, "zip")
+            self._add_project_supplementaries(request, project_folder)
+        return True
 
+    def _store_cached_result(self, request: ServiceRequest, cache_entry, information_items):
+        """Atomically persist the run's artifacts so identical submissions skip ilspycmd entirely."""
+        base = os.path.splitext(os.path.basename(request.file_path))[0]
+        temp_dir = None
+        try:
+            os.makedirs(os.path.dirname(cache_entry), exist_ok=True)
+            temp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_entry))
+            shutil.copy(os.path.join(self.working_directory, base + ".il"), os.path.join(temp_dir, "il"))
+            shutil.copy(
+                os.path.join(self.working_directory, base + ".decompiled.cs"),
+                os.path.join(temp_dir, "decompiled.cs"),
+            )
+            shutil.copy(
+                os.path.join(self.working_directory, "project.zip"), os.path.join(temp_dir, "project.zip")
+            )
+            # The manifest is written last so an interrupted entry is treated as a miss
+            with open(os.path.join(temp_dir, "manifest.json"), "w") as manifest_file:
+                json.dump({"assembly_info": information_items}, manifest_file)
+            os.rename(temp_dir, cache_entry)
+        except OSError as e:
+            # A cache failure (unwritable folder, concurrent worker winning the rename, ...)
+            # should never fail the request
+            self.log.warning(f"Could not cache decompilation results: {e}")
+            if temp_dir:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _add_assembly_info_section(self, request: ServiceRequest, information_items):
+        if not information_items:
+            return
         # ResultOrderedKeyValueSection allows duplicate keys
         # Some samples are using multiple InternalsVisibleTo with different values
         assembly_info = ResultOrderedKeyValueSection("Assembly Information")
-        information_keys = set()
-
-        with open(decompiled_file_path, "r") as decompiled_file:
-            for line in decompiled_file:
-                if line.startswith("[assembly: "):
-                    if "(" not in line or ")" not in line:
-                        # Information without a configuration value
-                        k = line[11:].split("]", 1)[0]
-                        v = ""
+        for k, v in information_items:
+            assembly_info.add_item(k, v)
+        request.result.add_section(assembly_info)
+        if any(k == "SuppressIldasm" for k, _ in information_items):
+            ResultSection(
+                "SuppressIldasm attribute found",
+                body=(
+                    "Author wanted to reduce visibility on this code, "
+                    "it may be genuine, but this was seen in malicious samples too."
+                ),
+                parent=assembly_info,
+            )
+
+    def _add_project_supplementaries(self, request: ServiceRequest, project_folder):
+        # os.scandir's DirEntry carries cached stat information, so unlike os.walk
+        # there is no second stat call per file during the traversal
+        folders = [project_folder]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
                     else:
-                        k, v = line[11:].split("(", 1)
-                        v = v[::-1].split(")", 1)[-1][::-1]
-                    assembly_info.add_item(k, v)
-                    information_keys.add(k)
-                elif assembly_info.body:
-                    # We could only parse Properties/AssemblyInfo.cs from the project extraction and it would be faster
-                    # than reading the whole concatenated decompiled result, but there some situations where the
-                    # concatenated decompiled result contains more information entries.
-                    # Since they are all in a single block, stop reading the file once we get over that block.
-                    break
-
-        if assembly_info.body:
-            request.result.add_section(assembly_info)
-            if "SuppressIldasm" in information_keys:
-                ResultSection(
-                    "SuppressIldasm attribute found",
-                    body=(
-                        "Author wanted to reduce visibility on this code, "
-                        "it may be genuine, but this was seen in malicious samples too."
-                    ),
-                    parent=assembly_info,
-                )
+                        rel_path = os.path.relpath(entry.path, project_folder)
+                        request.add_supplementary(name=rel_path, description="Project file", path=entry.path)
 
-        request.add_extracted(
-            name=os.path.basename(decompiled_file_path), description="Decompiled file", path=decompiled_file_path
-        )
+    def execute(self, request: ServiceRequest):
+        request.result = Result()
+
+        # A PE carrying CLR metadata is at least a few KB; don't even parse headers for
+        # truncated or garbage input
+        if os.path.getsize(request.file_path) < 512:
+            return
+
+        # Non-Dotnet files make every ilspycmd invocation start up only to fail with
+        # BadImageFormatException; the PE header answers the same question in microseconds
+        if not has_clr_metadata(request.file_path):
+            return
+
+        cache_entry = self._cache_entry(request.sha256)
+        if cache_entry and self._replay_cached_result(request, cache_entry):
+            return
 
+        scratch = tempfile.mkdtemp(dir=self._scratch_root or self.working_directory)
+        try:
+            self._decompile(request, cache_entry, scratch)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        # There is also the --generate-pdb option that could yield interesting information.
+
+    def _run_ilspycmd(self, file_path, scratch, project_folder):
+        """Run the two ilspycmd invocations, returning an (il_error, project_error) pair."""
+        il_popenargs = [
+            "ilspycmd",
+            "--disable-updatecheck",
+            "--ilcode",
+            # "--il-sequence-points", # Show IL with sequence points.
+            "--outputdir",
+            scratch,
+            file_path,
+        ]
         # For easier download, browsing, and compilation, split the project in multiple files
-        project_folder = os.path.join(self.working_directory, "project")
-        popenargs = [
+        project_popenargs = [
             "ilspycmd",
             "--disable-updatecheck",
             "--project",
             "--nested-directories",
             "--outputdir",
             project_folder,
-            request.file_path,
+            file_path,
+        ]
+        # With --outputdir, ilspycmd writes nothing useful on stdout; only stderr is inspected
+        procs = [
+            subprocess.Popen(popenargs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for popenargs in (il_popenargs, project_popenargs)
         ]
-        p = subprocess.run(popenargs, capture_output=True)
-        if p.returncode != 0:
+        (_, il_stderr), (_, project_stderr) = [p.communicate() for p in procs]
+        il_proc, project_proc = procs
+        return (
+            None if il_proc.returncode == 0 else il_stderr,
+            None if project_proc.returncode == 0 else project_stderr,
+        )
+
+    def _decompile(self, request: ServiceRequest, cache_entry, scratch):
+        # ILSpy always names its output after the input file
+        base = os.path.splitext(os.path.basename(request.file_path))[0]
+        project_folder = os.path.join(scratch, "project")
+
+        # The IL disassembly and the project split work on the same input independently, so they
+        # run concurrently. Their outputs cannot collide: the IL disassembly uses its own
+        # extension and the project split targets its own folder. The concatenated decompiled
+        # file is rebuilt from the project split afterwards instead of a dedicated pass, since
+        # both passes run the same decompiler over the same module and emit the same C#.
+        # In case decompilation is too mangled, the IL Code could give more hints as to what the executable is doing.
+        if self._ilspy_host is not None:
+            il_error, project_error = self._ilspy_host.run(request.file_path, scratch, project_folder)
+            if (il_error is not None and should_raise_ilspycmd_exception(il_error)) or (
+                project_error is not None and should_raise_ilspycmd_exception(project_error)
+            ):
+                # A host that initialized fine can still fail at call time (e.g. an assembly it
+                # cannot resolve); give the battle-tested CLI a chance before raising
+                self.log.warning("In-process decompilation failed unexpectedly, retrying with ilspycmd")
+                shutil.rmtree(project_folder, ignore_errors=True)
+                il_error, project_error = self._run_ilspycmd(request.file_path, scratch, project_folder)
+        else:
+            il_error, project_error = self._run_ilspycmd(request.file_path, scratch, project_folder)
+
+        if il_error is None:
+            il_file_path = os.path.join(self.working_directory, base + ".il")
+            shutil.move(os.path.join(scratch, base + ".il"), il_file_path)
+            request.add_supplementary(name=base + ".il", description="IL Code file", path=il_file_path)
+        elif should_raise_ilspycmd_exception(il_error):
+            # IL Code should always be available.
+            raise Exception(il_error)
+        else:
+            # A known error happened, no need to look at the other decompilations
             return
 
-        # Add the full project zip first, in case there ends up having a maximum on supplementary files
-        shutil.make_archive(os.path.join(self.working_directory, "project"), "zip", project_folder)
-        request.add_supplementary(
-            name="project.zip", description="Project folder", path=os.path.join(self.working_directory, "project.zip")
-        )
+        if project_error is not None:
+            if should_raise_ilspycmd_exception(project_error):
+                # Tell the user about the unexpected error, but assume that the ILCode will still help.
+                ResultSection(
+                    "ILSpyCmd Error",
+                    body=project_error.decode("UTF8", errors="backslashreplace"),
+                    parent=request.result,
+                )
+            return
 
+        # Rebuild the single-file view by concatenating the project sources
+        decompiled_file_path = os.path.join(self.working_directory, base + ".decompiled.cs")
+        source_files = []
         for root, _, files in os.walk(project_folder):
             for f in files:
-                file_path = os.path.join(root, f)
-                rel_path = os.path.join(os.path.relpath(root, project_folder), f)
-                if rel_path.startswith("./"):
-                    rel_path = rel_path[2:]
-                request.add_supplementary(name=rel_path, description="Project file", path=file_path)
+                if f.endswith(".cs"):
+                    source_files.append(os.path.join(root, f))
+        if not source_files:
+            raise Exception("No ILSpy decompilation found.")
+        with open(decompiled_file_path, "wb") as decompiled_file:
+            for source_file in sorted(source_files):
+                with open(source_file, "rb") as source:
+                    shutil.copyfileobj(source, decompiled_file)
 
-        # There is also the --generate-pdb option that could yield interesting information.
+        # Parsing Properties/AssemblyInfo.cs from the project extraction is faster than reading
+        # the whole concatenated decompiled result, and it is where ILSpy puts the attributes
+        # in the common case.
+        information_items = []
+        assembly_info_path = os.path.join(project_folder, "Properties", "AssemblyInfo.cs")
+        if os.path.exists(assembly_info_path):
+            information_items = read_assembly_attribute_block(assembly_info_path)
+        if not information_items:
+            # Some samples only expose their attributes in the concatenated result; pay for
+            # scanning the big file when the first pass found nothing
+            information_items = read_assembly_attribute_block(decompiled_file_path)
+
+        self._add_assembly_info_section(request, information_items)
+
+        request.add_extracted(
+            name=base + ".decompiled.cs", description="Decompiled file", path=decompiled_file_path
+        )
+
+        # Add the full project zip first, in case there ends up having a maximum on supplementary files
+        zip_path = os.path.join(self.working_directory, "project.zip")
+        archive_project(project_folder, zip_path)
+        request.add_supplementary(name="project.zip", description="Project folder", path=zip_path)
+
+        if self.config.get("emit_individual_project_files", False):
+            # The individual files must outlive the scratch folder for the framework to pick them up
+            persistent_project_folder = os.path.join(self.working_directory, "project")
+            shutil.move(project_folder, persistent_project_folder)
+            self._add_project_supplementaries(request, persistent_project_folder)
+
+        if cache_entry:
+            self._store_cached_result(request, cache_entry, information_items)
@@ -0,0 +1,112 @@
+"""Optional in-process host for the ILSpy decompiler engine.
+
+Every ilspycmd invocation pays CLR startup and assembly loading before any real work. When
+pythonnet is available, the service can instead load ICSharpCode.Decompiler (shipped inside
+the ilspycmd dotnet tool store) once and drive it directly, amortizing runtime startup over
+the life of the service.
+"""
+
+import concurrent.futures
+import glob
+import os
+
+# The assemblies are taken from the ilspycmd dotnet tool store set up in the Dockerfile
+ILSPYCMD_TOOL_STORE_GLOB = "/usr/bin/.store/ilspycmd/*/ilspycmd/*/tools/*/any"
+
+
+class IlspyHost:
+    """Drives ICSharpCode.Decompiler in-process, mirroring the two ilspycmd invocations."""
+
+    def __init__(self):
+        tool_folders = sorted(glob.glob(ILSPYCMD_TOOL_STORE_GLOB))
+        if not tool_folders:
+            raise RuntimeError("No ilspycmd tool store found to load ICSharpCode.Decompiler from")
+        tool_folder = tool_folders[-1]
+
+        from clr_loader import get_coreclr
+        from pythonnet import set_runtime
+
+        runtime_configs = sorted(glob.glob(os.path.join(tool_folder, "*.runtimeconfig.json")))
+        if not runtime_configs:
+            raise RuntimeError("No runtimeconfig.json found in the ilspycmd tool store")
+        set_runtime(get_coreclr(runtime_config=runtime_configs[0]))
+
+        import clr
+
+        clr.AddReference(os.path.join(tool_folder, "ICSharpCode.Decompiler.dll"))
+
+        from ICSharpCode.Decompiler import DecompilerSettings, PlainTextOutput
+        from ICSharpCode.Decompiler.CSharp.ProjectDecompiler import WholeProjectDecompiler
+        from ICSharpCode.Decompiler.Disassembler import ReflectionDisassembler
+        from ICSharpCode.Decompiler.Metadata import PEFile, UniversalAssemblyResolver
+        from System.IO import StreamWriter
+        from System.Threading import CancellationToken
+
+        self._DecompilerSettings = DecompilerSettings
+        self._PlainTextOutput = PlainTextOutput
+        self._WholeProjectDecompiler = WholeProjectDecompiler
+        self._ReflectionDisassembler = ReflectionDisassembler
+        self._PEFile = PEFile
+        self._UniversalAssemblyResolver = UniversalAssemblyResolver
+        self._StreamWriter = StreamWriter
+        self._cancellation_token = getattr(CancellationToken, "None")
+
+    def run(self, file_path, scratch, project_folder):
+        """Disassemble and project-decompile a file, returning an (il_error, project_error) pair.
+
+        Errors are stderr-like bytes (the surfaced .NET exception text carries the same
+        signatures the CLI printed) or None on success. pythonnet releases the GIL during
+        managed calls, so the two operations overlap the same way the CLI invocations did.
+        """
+        base = os.path.splitext(os.path.basename(file_path))[0]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            il_future = pool.submit(self._disassemble, file_path, os.path.join(scratch, base + ".il"))
+            project_future = pool.submit(self._decompile_project, file_path, project_folder)
+            return self._error_of(il_future), self._error_of(project_future)
+
+    @staticmethod
+    def _error_of(future):
+        try:
+            future.result()
+            return None
+        except Exception as e:
+            # str() on a surfaced .NET exception is the Message only; prepend the qualified
+            # type name so the text carries the same signatures the CLI printed via ToString()
+            # (e.g. "System.NullReferenceException: Object reference not set ...")
+            return f"{type(e).__module__}.{type(e).__name__}: {e}".encode("utf-8", "backslashreplace")
+
+    def _resolver(self, file_path, module):
+        return self._UniversalAssemblyResolver(file_path, False, module.DetectTargetFrameworkId())
+
+    def _disassemble(self, file_path, output_path):
+        # PEFile holds the open file and PE reader; dispose it deterministically rather than
+        # leaving handle release to GC finalization in this long-lived host
+        module = self._PEFile(file_path)
+        try:
+            writer = self._StreamWriter(output_path)
+            try:
+                output = self._PlainTextOutput(writer)
+                disassembler = self._ReflectionDisassembler(output, self._cancellation_token)
+                disassembler.AssemblyResolver = self._resolver(file_path, module)
+                disassembler.WriteAssemblyReferences(module.Metadata)
+                if module.Metadata.IsAssembly:
+                    disassembler.WriteAssemblyHeader(module)
+                output.WriteLine()
+                disassembler.WriteModuleHeader(module)
+                output.WriteLine()
+                disassembler.WriteModuleContents(module)
+            finally:
+                writer.Dispose()
+        finally:
+            module.Dispose()
+
+    def _decompile_project(self, file_path, project_folder):
+        os.makedirs(project_folder, exist_ok=True)
+        module = self._PEFile(file_path)
+        try:
+            settings = self._DecompilerSettings()
+            settings.UseNestedDirectoriesForNamespaces = True
+            decompiler = self._WholeProjectDecompiler(settings, self._resolver(file_path, module), None, None)
+            decompiler.DecompileProject(module, project_folder)
+        finally:
+            module.Dispose()
@@ -0,0 +1,35 @@
+import concurrent.futures
+
+from dotnet_decompiler.dotnet_decompiler import should_raise_ilspycmd_exception
+from dotnet_decompiler.ilspy_host import IlspyHost
+
+
+class NullReferenceException(Exception):
+    pass
+
+
+# Mimic how pythonnet exposes a .NET exception type
+NullReferenceException.__module__ = "System"
+
+
+def test_message_only_nre_is_classified_benign():
+    # pythonnet surfaces only the exception Message through str(); the host must add the
+    # type name back so the benign-error signatures still match
+    future = concurrent.futures.Future()
+    future.set_exception(NullReferenceException("Object reference not set to an instance of an object."))
+    error = IlspyHost._error_of(future)
+    assert error.startswith(b"System.NullReferenceException: Object reference not set")
+    assert should_raise_ilspycmd_exception(error) is False
+
+
+def test_unexpected_error_is_classified_as_raise():
+    future = concurrent.futures.Future()
+    future.set_exception(NullReferenceException("Something else entirely"))
+    error = IlspyHost._error_of(future)
+    assert should_raise_ilspycmd_exception(error) is True
+
+
+def test_success_has_no_error():
+    future = concurrent.futures.Future()
+    future.set_result(None)
+    assert IlspyHost._error_of(future) is None